@@ -31,51 +31,338 @@
 import re
 import os
 import sys
+import json
+import time
+import unicodedata
 import operator
 import argparse
 import subprocess
+import concurrent.futures
 
-GIT_LOG_CMD = "git shortlog --summary --numbered --email"
+# Every commit starts with a NUL-prefixed header line:
+# author name, author email, and author timestamp.
+# With --numstat, "added<TAB>removed<TAB>path" lines follow it.
+# Name and email are mailmap-aware, just like in shortlog.
+GIT_LOG_CMD = ["log", "--format=%x00%aN%x00%aE%x00%at"]
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--pull', action='store_true', help='Force git pull')
 parser.add_argument('--since', type=str, help='Earliest date to count from')
+parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of repos to process in parallel')
+parser.add_argument('--cache', type=str, help='Cache file for per-repo counts')
+parser.add_argument('--dates', action='store_true', help='Show first and last commit dates')
+parser.add_argument('--numstat', action='store_true', help='Count lines added and removed')
+parser.add_argument('--period', type=str, choices=['month', 'quarter'], help='Show commit counts per period')
+parser.add_argument('--mailmap', action='store_true', help='Apply .mailmap files of every repo to all repos')
+parser.add_argument('--merge-names', action='store_true', help='Treat addresses with the same normalized author name as one contributor')
 parser.add_argument('source_path', type=str, help='Path to the directory with git repos')
 
 args = parser.parse_args()
 
 if args.since:
-    GIT_LOG_CMD += " --since {0}".format(args.since)
+    GIT_LOG_CMD += ["--since", args.since]
 
-repos = filter(lambda x: os.path.isdir(os.path.join(args.source_path, x)), os.listdir(args.source_path))
+if args.numstat:
+    GIT_LOG_CMD += ["--numstat"]
+
+repos = sorted(filter(lambda x: os.path.isdir(os.path.join(args.source_path, x)), os.listdir(args.source_path)))
 
 contributors = {}
 
-def update_contributors(contributors):
-    cmd = GIT_LOG_CMD
+# The cache maps repo names to their HEAD commit at the time of the last run,
+# the --since and --numstat values used, and the per-email counts.
+#
+# Note that relative dates like "1 year ago" move with time,
+# so cached counts made with such --since values go stale.
+def load_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        print("Cache file {0} is malformed, ignoring it".format(path), file=sys.stderr)
+        return {}
 
-    p = subprocess.Popen([cmd], stdout=subprocess.PIPE, shell=True)
-    out = p.stdout.readlines()
+def save_cache(path, cache):
+    tmp_path = "{0}.tmp".format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
 
-    for l in out:
-        commits, name, email = re.match(r'^\s*(\d+)\s+(.*)\s+<(.*)>\s*$', l.decode()).groups()
-        if email in contributors:
-            contributors[email]['commits'] += int(commits)
-        else:
-            contributors[email] = {}
-            contributors[email]['commits'] = int(commits)
-            contributors[email]['name'] = name
+def git(repo_path, *git_args):
+    return subprocess.run(["git", "-C", repo_path] + list(git_args),
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+
+def git_head(repo_path):
+    res = git(repo_path, "rev-parse", "HEAD")
+    if res.returncode != 0:
+        return None
+    return res.stdout.decode().strip()
+
+def is_ancestor(repo_path, old_head, new_head):
+    return git(repo_path, "merge-base", "--is-ancestor", old_head, new_head).returncode == 0
+
+def new_entry(name):
+    return {'commits': 0, 'name': name, 'first': None, 'last': None,
+            'added': 0, 'removed': 0, 'months': {}}
+
+# Reads the log of the given revision range as a stream
+# and returns an email -> {commits, name, first, last, added, removed, months} dict.
+#
+# All aggregations are done in the same pass over the log,
+# "months" maps "YYYY-MM" to the number of commits made in that month.
+#
+# Returns None if git log fails, since the counts are incomplete then.
+def read_log(repo_path, revision):
+    counts = {}
+    entry = None
+
+    with subprocess.Popen(["git", "-C", repo_path] + GIT_LOG_CMD + [revision],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL) as proc:
+        for l in proc.stdout:
+            l = l.decode(errors='replace')
+            if l.startswith('\0'):
+                _, name, email, timestamp = l.rstrip('\n').split('\0')
+                timestamp = int(timestamp)
+
+                if email not in counts:
+                    counts[email] = new_entry(name)
+                entry = counts[email]
+
+                entry['commits'] += 1
+                if (entry['first'] is None) or (timestamp < entry['first']):
+                    entry['first'] = timestamp
+                if (entry['last'] is None) or (timestamp > entry['last']):
+                    entry['last'] = timestamp
 
-for r in repos:
-    repo_path = os.path.join(args.source_path, r)
+                month = time.strftime("%Y-%m", time.gmtime(timestamp))
+                entry['months'][month] = entry['months'].get(month, 0) + 1
+            elif l.strip() and (entry is not None):
+                # Binary files are shown as "-<TAB>-<TAB>path", we don't count those
+                added, removed, _ = l.split('\t', 2)
+                if added != '-':
+                    entry['added'] += int(added)
+                    entry['removed'] += int(removed)
+
+        if proc.wait() != 0:
+            print("Failed to read the log of {0}".format(repo_path), file=sys.stderr)
+            return None
+
+    return counts
+
+# Counts commits in a single repo, returns its HEAD and an email -> counts dict.
+# It uses "git -C" rather than chdir so that it's safe to run from multiple threads.
+#
+# If the cache has an entry for a repo, unchanged repos are skipped entirely,
+# and for repos that only moved forward, only the new commits are counted.
+#
+# If the log can't be read, the returned HEAD is None
+# so that incomplete counts never make it to the cache.
+def count_contributors(repo_path, cached):
     print("Processing {0}".format(repo_path), file=sys.stderr)
-    os.chdir(repo_path)
+
     if args.pull:
-        os.system("git pull")
-    update_contributors(contributors)
+        subprocess.run(["git", "-C", repo_path, "pull"], stdout=sys.stderr)
+
+    head = git_head(repo_path)
+
+    if cached and (head is not None) and (cached['since'] == args.since) and (cached.get('numstat') == args.numstat):
+        if cached['head'] == head:
+            return (head, cached['counts'])
+        elif is_ancestor(repo_path, cached['head'], head):
+            new_counts = read_log(repo_path, "{0}..{1}".format(cached['head'], head))
+            if new_counts is None:
+                # Report what we know from the last run, but keep the old cache entry
+                return (None, cached['counts'])
+            counts = cached['counts']
+            update_contributors(counts, new_counts)
+            return (head, counts)
+
+    counts = read_log(repo_path, "HEAD")
+    if counts is None:
+        return (None, {})
+
+    return (head, counts)
+
+# Maps author emails to canonical contributor identities.
+#
+# It's a union-find structure over lowercased emails:
+# every set of addresses known to belong to the same person
+# has one root address that is used as the contributor key.
+#
+# Proper emails from mailmaps are preferred as roots,
+# and proper names are kept by proper email, so that later unions
+# don't lose them.
+class IdentityIndex(object):
+    def __init__(self):
+        self.parent = {}
+        self.proper_emails = set()
+        self.names = {}
+        self._root_names = None
+
+    def _find(self, key):
+        self.parent.setdefault(key, key)
+        root = key
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression
+        while self.parent[key] != root:
+            self.parent[key], key = root, self.parent[key]
+        return root
+
+    # Merges the set of alias into the set of email.
+    # The root of the email set stays the root, unless only the alias set
+    # is rooted at a mailmap proper email.
+    def union(self, email, alias):
+        root = self._find(email.lower())
+        alias_root = self._find(alias.lower())
+        if root == alias_root:
+            return
+        if (alias_root in self.proper_emails) and (root not in self.proper_emails):
+            root, alias_root = alias_root, root
+        self.parent[alias_root] = root
+        self._root_names = None
+
+    def find(self, email):
+        return self._find(email.lower())
+
+    # Must only be called after all unions are done
+    def name(self, email, default):
+        if self._root_names is None:
+            self._root_names = {}
+            # The root's own proper name wins over the names of other proper emails in its set
+            for proper_email in sorted(self.names, key=lambda e: self._find(e) != e):
+                self._root_names.setdefault(self._find(proper_email), self.names[proper_email])
+        return self._root_names.get(self.find(email), default)
+
+    # Mailmap lines can have these forms:
+    #   Proper Name <commit@email>
+    #   <proper@email> <commit@email>
+    #   Proper Name <proper@email> <commit@email>
+    #   Proper Name <proper@email> Commit Name <commit@email>
+    def load_mailmap(self, path):
+        try:
+            with open(path, 'r', errors='replace') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+
+        for l in lines:
+            l = re.sub(r'#.*', '', l)
+            res = re.match(r'^\s*([^<]*?)\s*<([^>]*)>(?:\s*[^<]*?\s*<([^>]*)>)?', l)
+            if not res:
+                continue
+
+            proper_name, proper_email, commit_email = res.groups()
+            proper_email = proper_email.lower()
+            self.proper_emails.add(proper_email)
+            if commit_email:
+                self.union(proper_email, commit_email)
+            if proper_name:
+                self.names[proper_email] = proper_name
+
+    # Joins all addresses whose author names are the same
+    # up to case, accents, punctuation, and whitespace
+    def merge_names(self, names):
+        by_name = {}
+        for email, name in names:
+            norm = unicodedata.normalize('NFKD', name)
+            norm = "".join([c for c in norm if not unicodedata.combining(c)])
+            norm = " ".join(re.split(r'[\W_]+', norm.casefold())).strip()
+            if not norm:
+                continue
+            if norm in by_name:
+                self.union(by_name[norm], email)
+            else:
+                by_name[norm] = email
+
+def update_contributors(contributors, counts, index=None):
+    for email in counts:
+        src = counts[email]
+        if index:
+            key = index.find(email)
+            name = index.name(email, src['name'])
+        else:
+            key = email
+            name = src['name']
+
+        if key not in contributors:
+            contributors[key] = new_entry(name)
+        dst = contributors[key]
+
+        dst['commits'] += src['commits']
+        dst['added'] += src['added']
+        dst['removed'] += src['removed']
+
+        if (dst['first'] is None) or (src['first'] < dst['first']):
+            dst['first'] = src['first']
+        if (dst['last'] is None) or (src['last'] > dst['last']):
+            dst['last'] = src['last']
+
+        for month in src['months']:
+            dst['months'][month] = dst['months'].get(month, 0) + src['months'][month]
+
+def format_date(timestamp):
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+# Converts the "YYYY-MM" -> commits dict into per-period buckets
+def period_counts(months, period):
+    periods = {}
+    for month in months:
+        if period == 'quarter':
+            year, m = month.split('-')
+            key = "{0}-Q{1}".format(year, (int(m) - 1) // 3 + 1)
+        else:
+            key = month
+        periods[key] = periods.get(key, 0) + months[month]
+    return periods
+
+repo_paths = [os.path.join(args.source_path, r) for r in repos]
+
+if args.cache:
+    cache = load_cache(args.cache)
+else:
+    cache = {}
+cached_entries = [cache.get(r) for r in repos]
+
+if args.jobs > 1:
+    # The work is almost entirely in git subprocesses, so threads are enough
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(count_contributors, repo_paths, cached_entries))
+else:
+    results = list(map(count_contributors, repo_paths, cached_entries))
+
+# The identity index is built once from all mailmaps and author names,
+# then applied while the per-repo counts are merged
+if args.mailmap or args.merge_names:
+    index = IdentityIndex()
+    if args.mailmap:
+        for repo_path in repo_paths:
+            index.load_mailmap(os.path.join(repo_path, ".mailmap"))
+    if args.merge_names:
+        index.merge_names([(email, counts[email]['name']) for _, counts in results for email in counts])
+else:
+    index = None
+
+for r, (head, counts) in zip(repos, results):
+    if head is not None:
+        cache[r] = {'head': head, 'since': args.since, 'numstat': args.numstat, 'counts': counts}
+    update_contributors(contributors, counts, index)
+
+if args.cache:
+    save_cache(args.cache, cache)
 
 contributors = sorted(contributors.items(), key=lambda x: operator.itemgetter(1)(x)['commits'], reverse=True)
 
 for k in contributors:
     email, data = k
-    print("{0} {1} {2}".format(data['commits'], data['name'], email))
+    line = "{0} {1} {2}".format(data['commits'], data['name'], email)
+    if args.dates:
+        line += " {0} {1}".format(format_date(data['first']), format_date(data['last']))
+    if args.numstat:
+        line += " +{0} -{1}".format(data['added'], data['removed'])
+    if args.period:
+        periods = period_counts(data['months'], args.period)
+        line += " " + ",".join(["{0}:{1}".format(p, periods[p]) for p in sorted(periods)])
+    print(line)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+#
+# Measures the cold start time of cve2bibtex.py per record,
+# that is, how long it takes to start a new process and convert one record from stdin,
+# like a Makefile-driven bibliography build does.
+#
+# Usage: cve2bibtex-bench.py [-n RUNS] [--max-ms MS] record.json
+#
+# With --max-ms, it exits with a non-zero code if the median time per record
+# exceeds the limit, so it can be used to catch regressions.
+#
+# Copyright (c) 2023 Daniil Baturin <daniil@baturin.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE
+# FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', type=int, default=20, help='Number of runs')
+    parser.add_argument('--max-ms', type=float, help='Fail if the median time per record exceeds this many milliseconds')
+    parser.add_argument('--script', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "cve2bibtex.py"),
+                        help='Path to cve2bibtex.py')
+    parser.add_argument('record', type=str, help='CVE JSON record file')
+    args = parser.parse_args()
+
+    times = []
+    for _ in range(args.runs):
+        with open(args.record, 'rb') as f:
+            start = time.perf_counter()
+            res = subprocess.run([sys.executable, args.script], stdin=f, stdout=subprocess.DEVNULL)
+            times.append((time.perf_counter() - start) * 1000)
+        if res.returncode != 0:
+            print("cve2bibtex.py failed to convert {0}".format(args.record), file=sys.stderr)
+            sys.exit(1)
+
+    median = statistics.median(times)
+    print("runs: {0}, per record: median {1:.1f} ms, min {2:.1f} ms, max {3:.1f} ms".format(args.runs, median, min(times), max(times)))
+
+    if (args.max_ms is not None) and (median > args.max_ms):
+        print("Median time per record {0:.1f} ms exceeds the limit of {1} ms".format(median, args.max_ms), file=sys.stderr)
+        sys.exit(1)
@@ -8,6 +8,15 @@
 #
 # Typical usage: curl https://cveawg.mitre.org/api/cve/CVE-2023-38408 | cve2bibtex
 #
+# It can also convert many records at once, e.g. a whole cvelistV5 checkout,
+# into a single .bib file:
+# cve2bibtex --jobs 8 --output cves.bib cvelistV5/cves/
+#
+# With a local cvelistV5 checkout, it can look up records by their IDs.
+# The first run builds an index of the checkout, later runs only reindex files
+# changed since the last indexed commit:
+# cve2bibtex --tree cvelistV5/ CVE-2023-38408 CVE-2024-3094
+#
 # Copyright (c) 2023 Daniil Baturin <daniil@baturin.org>
 #
 # Permission is hereby granted, free of charge, to any person obtaining a copy
@@ -28,38 +37,294 @@
 
 
 import re
+import os
 import sys
+import glob
 import json
-import dateutil.parser
+import argparse
+import datetime
+
+# sqlite3, subprocess, and multiprocessing are only needed in batch and index modes,
+# so they are imported where they are used.
+# Conversion of a single record is often run thousands of times from a Makefile,
+# and those imports would dominate its run time.
 
-data = json.load(sys.stdin)
+# Returns the (year, month) tuple for a CVE timestamp.
+#
+# Valid records use ISO 8601, but fromisoformat() only accepts the "Z" suffix
+# since Python 3.11, and some old records have timestamps
+# in odd formats, so we fall back to just taking the leading date.
+def parse_date(timestamp):
+    try:
+        date = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+        return (date.year, date.month)
+    except ValueError:
+        res = re.match(r'^\s*(\d{4})-?(\d{2})', timestamp)
+        if not res:
+            raise ValueError(f"Malformed timestamp: {timestamp}")
+        return (int(res.group(1)), int(res.group(2)))
 
-cve_id = data["cveMetadata"]["cveId"]
+class NoDescriptionError(ValueError):
+    pass
 
-cve_date = dateutil.parser.isoparse(data["cveMetadata"]["datePublished"])
-cve_year = cve_date.year
-cve_month = cve_date.month
+# Extracts the data we need from a CVE record: (ID, publication date, description)
+def record_fields(data):
+    cve_id = data["cveMetadata"]["cveId"]
+    cve_date = data["cveMetadata"]["datePublished"]
 
-cve_url = f"https://www.cve.org/CVERecord?id={cve_id}"
+    # Find any English description
+    # The descriptions field is an array of {"lang": $code, "value": $desc} objects.
+    #
+    # In practice, all CVEs have one with {"lang": "en"},
+    # but the schema demands support for regional variants:
+    # https://github.com/CVEProject/cve-schema/blob/8994b0ac23f89d7b2c8d750500bc88400e4336d7/schema/v5.0/CVE_JSON_5.0_schema.json#L1027-L1031
+    cve_desc = None
+    for d in data["containers"]["cna"].get("descriptions", []):
+        if re.match(r'^en([_-][A-Za-z]{4})?([_-]([A-Za-z]{2}|[0-9]{3}))?$', d["lang"]):
+            cve_desc = d["value"]
 
-# Find any English description
-# The descriptions field is an array of {"lang": $code, "value": $desc} objects.
-#
-# In practice, all CVEs have one with {"lang": "en"},
-# but the schema demands support for regional variants:
-# https://github.com/CVEProject/cve-schema/blob/8994b0ac23f89d7b2c8d750500bc88400e4336d7/schema/v5.0/CVE_JSON_5.0_schema.json#L1027-L1031
-for d in data["containers"]["cna"]["descriptions"]:
-    if re.match(r'^en([_-][A-Za-z]{4})?([_-]([A-Za-z]{2}|[0-9]{3}))?$', d["lang"]):
-        cve_desc = d["value"]
-
-bibtex_tmpl = f"""
+    if cve_desc is None:
+        raise NoDescriptionError(f"{cve_id} has no English description")
+
+    return (cve_id, cve_date, cve_desc)
+
+def format_bibtex(cve_id, cve_date, cve_desc):
+    cve_year, cve_month = parse_date(cve_date)
+
+    cve_url = f"https://www.cve.org/CVERecord?id={cve_id}"
+
+    bibtex_tmpl = f"""
 @online{{{cve_id},
   author = {{MITRE}},
   title = {{{cve_id}: {cve_desc}}},
-  month = {cve_month}
+  month = {cve_month},
   year = {cve_year},
   url = {{{cve_url}}},
 }}
 """
 
-print(bibtex_tmpl)
+    return bibtex_tmpl
+
+def make_bibtex(data):
+    return format_bibtex(*record_fields(data))
+
+# Finds all CVE record files in given files, directories, and glob patterns
+def find_records(paths):
+    for p in paths:
+        if os.path.isdir(p):
+            for root, dirs, files in os.walk(p):
+                # Keep the output order stable
+                dirs.sort()
+                for f in sorted(files):
+                    if re.match(r'^CVE-\d+-\d+\.json$', f):
+                        yield os.path.join(root, f)
+        elif glob.has_magic(p):
+            yield from sorted(glob.iglob(p, recursive=True))
+        else:
+            yield p
+
+# Worker function for the batch mode and indexing: never raises,
+# so that one bad record doesn't stop the whole batch.
+#
+# Returns (path, fields, error), fields are None for records that
+# have no publication date or description because they are rejected or reserved.
+# The error is the exception object, so that callers can tell its kind.
+def read_record(path):
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data["cveMetadata"].get("state") != "PUBLISHED":
+            return (path, None, None)
+        return (path, record_fields(data), None)
+    except Exception as e:
+        return (path, None, e)
+
+def convert_file(path):
+    path, fields, err = read_record(path)
+    if fields is not None:
+        return (path, format_bibtex(*fields), None)
+    else:
+        return (path, None, err)
+
+class CVEIndex(object):
+    """ SQLite index of a local cvelistV5 checkout.
+
+        It stores the ID, publication date and English description of every
+        published record, and the commit of the checkout it was last updated to,
+        so that only records changed since then need to be parsed again.
+        If any record fails to index, the commit is not updated,
+        so the same changes are tried again on the next run.
+
+        By default the index is kept inside the .git dir of the checkout,
+        so that it doesn't show up as an untracked file.
+    """
+    def __init__(self, tree, index_path, jobs):
+        import sqlite3
+
+        self.tree = tree
+        self.jobs = jobs
+
+        if index_path is None:
+            index_path = self._default_index_path()
+
+        self.db = sqlite3.connect(index_path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cves (id TEXT PRIMARY KEY, path TEXT, date_published TEXT, description TEXT) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _git(self, *git_args):
+        import subprocess
+
+        res = subprocess.run(["git", "-C", self.tree] + list(git_args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if res.returncode != 0:
+            return None
+        return res.stdout.decode()
+
+    def _default_index_path(self):
+        git_dir = self._git("rev-parse", "--absolute-git-dir")
+        if git_dir is not None:
+            return os.path.join(git_dir.strip(), "cve2bibtex.sqlite")
+
+        # Not a git checkout, use the user cache dir
+        cache_dir = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(cache_dir, "cve2bibtex.sqlite")
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    # Returns the number of files that could not be indexed
+    def _index_files(self, paths):
+        import multiprocessing
+
+        failures = 0
+
+        with multiprocessing.Pool(self.jobs) as pool:
+            for path, fields, err in pool.imap_unordered(read_record, paths, chunksize=256):
+                rel_path = os.path.relpath(path, self.tree)
+                if isinstance(err, NoDescriptionError):
+                    # Reindexing won't help with that, it's like a record that is not published
+                    self.db.execute("DELETE FROM cves WHERE path = ?", (rel_path,))
+                elif err is not None:
+                    print(f"Could not index {path}: {err}", file=sys.stderr)
+                    failures += 1
+                elif fields is None:
+                    self.db.execute("DELETE FROM cves WHERE path = ?", (rel_path,))
+                else:
+                    cve_id, cve_date, cve_desc = fields
+                    self.db.execute("INSERT OR REPLACE INTO cves VALUES (?, ?, ?, ?)", (cve_id, rel_path, cve_date, cve_desc))
+
+        return failures
+
+    def _rebuild(self):
+        print(f"Building the index of {self.tree}, this may take a while", file=sys.stderr)
+        self.db.execute("DELETE FROM cves")
+        return self._index_files(find_records([self.tree]))
+
+    def update(self):
+        head = self._git("rev-parse", "HEAD")
+        if head is not None:
+            head = head.strip()
+
+        indexed_commit = self._get_meta("commit")
+
+        if (indexed_commit is not None) and (indexed_commit == head):
+            return
+        elif (indexed_commit is not None) and (head is not None):
+            # With --relative, paths are relative to the tree rather than the repo top dir,
+            # and changes outside of the tree are not listed
+            changes = self._git("diff", "--name-status", "--no-renames", "--relative", "-z", indexed_commit, head)
+            if changes is None:
+                # The old commit may be gone after a force push, start over
+                failures = self._rebuild()
+            else:
+                changes = changes.split("\0")
+                changed_files = []
+                for status, path in zip(changes[0::2], changes[1::2]):
+                    if not re.match(r'^CVE-\d+-\d+\.json$', os.path.basename(path)):
+                        continue
+                    if status == "D":
+                        self.db.execute("DELETE FROM cves WHERE path = ?", (path,))
+                    else:
+                        changed_files.append(os.path.join(self.tree, path))
+                failures = self._index_files(changed_files)
+        elif (head is not None) or (self.db.execute("SELECT 1 FROM cves LIMIT 1").fetchone() is None):
+            # Either there's no index yet, or the last build had failures
+            failures = self._rebuild()
+        else:
+            # Not a git checkout, so there's no way to tell what changed
+            print(f"{self.tree} is not a git repository, the index will not be updated", file=sys.stderr)
+            failures = 0
+
+        if (head is not None) and (failures == 0):
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('commit', ?)", (head,))
+        elif failures > 0:
+            print(f"{failures} records could not be indexed, they will be tried again on the next run", file=sys.stderr)
+        self.db.commit()
+
+    def lookup(self, cve_id):
+        return self.db.execute("SELECT id, date_published, description FROM cves WHERE id = ?", (cve_id,)).fetchone()
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return value
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', type=str, help='Output file (default: stdout)')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('-t', '--tree', type=str, help='Local cvelistV5 checkout for looking up records by ID')
+    parser.add_argument('-i', '--index', type=str, help='Index file (default: cve2bibtex.sqlite in the .git dir of the checkout)')
+    parser.add_argument('paths', type=str, nargs='*', help='CVE IDs, JSON files, directories, or glob patterns (default: read one record from stdin)')
+    args = parser.parse_args()
+
+    if not args.paths:
+        data = json.load(sys.stdin)
+        print(make_bibtex(data))
+        sys.exit(0)
+
+    cve_ids = [p for p in args.paths if re.match(r'^CVE-\d+-\d+$', p, re.IGNORECASE) and not os.path.exists(p)]
+    paths = [p for p in args.paths if p not in cve_ids]
+
+    if cve_ids and not args.tree:
+        print("Looking up CVEs by ID requires a local checkout (--tree)", file=sys.stderr)
+        sys.exit(1)
+
+    if args.output:
+        out = open(args.output, 'w')
+    else:
+        out = sys.stdout
+
+    exit_code = 0
+
+    # Records are written as soon as they are converted, in the input order,
+    # so the whole bibliography is never held in memory
+    if paths:
+        import multiprocessing
+
+        with multiprocessing.Pool(args.jobs) as pool:
+            for path, bibtex, err in pool.imap(convert_file, find_records(paths), chunksize=64):
+                if err is not None:
+                    print(f"Could not convert {path}: {err}", file=sys.stderr)
+                    exit_code = 1
+                elif bibtex is not None:
+                    out.write(bibtex)
+
+    if cve_ids:
+        index = CVEIndex(args.tree, args.index, args.jobs)
+        index.update()
+
+        for cve_id in cve_ids:
+            fields = index.lookup(cve_id.upper())
+            if fields is None:
+                print(f"{cve_id} is not found in {args.tree}", file=sys.stderr)
+                exit_code = 1
+            else:
+                out.write(format_bibtex(*fields))
+
+    if args.output:
+        out.close()
+
+    sys.exit(exit_code)
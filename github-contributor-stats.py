@@ -25,46 +25,247 @@
 # Synopsis: expors repository contributor data from GitHub over its REST API
 #
 # Usage: GITHUB_TOKEN=... github-contributors.py user/repo
+#
+# It can also process many repos, or all repos of an organization, at once:
+#   github-contributors.py user/repo1 user/repo2 org:myorg
+# Then it outputs a CSV with a header, with total and per-repo contributions of each user.
+# Every user is looked up only once, no matter in how many repos they appear.
+#
+# User data is fetched concurrently (see --jobs). The fetcher follows the rate limit headers:
+# when the quota is exhausted or GitHub asks to retry after some time, all workers wait.
+#
+# Responses are cached on disk (see --cache) together with their ETags.
+# Cached data is revalidated with If-None-Match, and 304 responses don't count against the rate limit.
+# User registration dates never change, so cached user profiles are used without any requests at all.
 
 import os
 import sys
 import json
-import urllib.request
+import time
+import argparse
+import threading
+import http.client
+import urllib.parse
+import concurrent.futures
+
+class GitHubClient(object):
+    """ A minimal GitHub REST API client that is safe to use from multiple threads.
+
+        Every thread keeps its own keep-alive connection,
+        and all threads share the rate limit state and the response cache.
+    """
+    def __init__(self, api_url, token=None, max_retries=5, cache_path=None):
+        url = urllib.parse.urlsplit(api_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip("/")
+        self.token = token
+        self.max_retries = max_retries
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Time before which no requests should be sent
+        self._not_before = 0
+
+        # URL -> {"etag": ..., "data": ...}
+        self.cache_path = cache_path
+        self._cache = {}
+        if cache_path:
+            try:
+                with open(cache_path, 'r') as f:
+                    self._cache = json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                print("Cache file {0} is malformed, ignoring it".format(cache_path), file=sys.stderr)
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+        with self._lock:
+            data = json.dumps(self._cache)
+        tmp_path = "{0}.tmp".format(self.cache_path)
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.cache_path)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.scheme == "https":
+                conn = http.client.HTTPSConnection(self.netloc, timeout=60)
+            else:
+                conn = http.client.HTTPConnection(self.netloc, timeout=60)
+            self._local.conn = conn
+        return conn
+
+    def _reset_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    # Only the thread that extends the pause reports it,
+    # other threads just wait silently
+    def _pause_until(self, timestamp):
+        with self._lock:
+            if timestamp <= self._not_before:
+                return
+            self._not_before = timestamp
+        delay = timestamp - time.time()
+        if delay > 0:
+            print("Waiting {0:.0f} seconds for the rate limit to reset".format(delay), file=sys.stderr)
+
+    def _wait(self):
+        with self._lock:
+            delay = self._not_before - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    # If immutable is True, cached data is returned without revalidation
+    def make_request(self, path, immutable=False):
+        cache_key = "{0}://{1}{2}{3}".format(self.scheme, self.netloc, self.prefix, path)
+        with self._lock:
+            cached = self._cache.get(cache_key)
 
-def make_request(query_url):
-    req = urllib.request.Request(query_url)
-    token = os.getenv("GITHUB_TOKEN")
-    if token:
-        req.add_header("Authorization", "token {0}".format(token))
+        if cached and immutable:
+            return cached["data"]
 
-    with urllib.request.urlopen(req) as f:
-        data = json.load(f)
+        headers = {"Accept": "application/vnd.github+json", "User-Agent": "github-contributor-stats"}
+        if self.token:
+            headers["Authorization"] = "token {0}".format(self.token)
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
 
-    return data
+        for attempt in range(self.max_retries + 1):
+            self._wait()
 
-def fetch_contributors(repo):
-    contributors = []
-    page = 0
+            try:
+                conn = self._connection()
+                conn.request("GET", self.prefix + path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (OSError, http.client.HTTPException) as e:
+                # Network errors and connections dropped by the server
+                self._reset_connection()
+                print("Request to {0} failed ({1}), retrying".format(path, e), file=sys.stderr)
+                time.sleep(2 ** attempt)
+                continue
+
+            remaining = resp.getheader("X-RateLimit-Remaining")
+            reset = resp.getheader("X-RateLimit-Reset")
+            retry_after = resp.getheader("Retry-After")
+
+            if (remaining == "0") and reset:
+                self._pause_until(int(reset))
+
+            if resp.status == 200:
+                data = json.loads(body)
+                if self.cache_path:
+                    with self._lock:
+                        self._cache[cache_key] = {"etag": resp.getheader("ETag"), "data": data}
+                return data
+            elif (resp.status == 304) and cached:
+                return cached["data"]
+            elif resp.status == 204:
+                # E.g. contributors of an empty repo
+                return []
+            elif (resp.status in [403, 429]) and (retry_after or (remaining == "0")):
+                # Primary or secondary rate limit
+                if retry_after:
+                    self._pause_until(time.time() + int(retry_after))
+                continue
+            elif resp.status in [403, 429]:
+                # Secondary rate limits are not always announced with headers,
+                # GitHub asks to wait at least a minute before retrying in that case.
+                # A 403 can also mean the token has no access,
+                # but then the retries will fail the same way.
+                self._pause_until(time.time() + 60 * (2 ** attempt))
+                continue
+            elif resp.status >= 500:
+                time.sleep(2 ** attempt)
+                continue
+            else:
+                raise RuntimeError("Request to {0} failed: {1} {2}".format(path, resp.status, body.decode(errors='replace')))
+
+        raise RuntimeError("Request to {0} failed after {1} retries".format(path, self.max_retries))
+
+def fetch_all_pages(client, path):
+    items = []
+    # Pages are numbered from 1, page 0 is the same as page 1
+    page = 1
     while True:
-        query_url = "https://api.github.com/repos/{0}/contributors?page={1}".format(repo, page)
-        data = make_request(query_url)
+        data = client.make_request("{0}?per_page=100&page={1}".format(path, page))
         if data:
-            contributors += data
+            items += data
             page += 1
         else:
             break
 
-    return contributors
+    return items
+
+def fetch_contributors(client, repo):
+    return fetch_all_pages(client, "/repos/{0}/contributors".format(repo))
+
+def fetch_org_repos(client, org):
+    return [r["full_name"] for r in fetch_all_pages(client, "/orgs/{0}/repos".format(org))]
+
+def fetch_registration_year(client, login):
+    # Registration date never changes, no need to revalidate
+    user_data = client.make_request("/users/{0}".format(login), immutable=True)
+
+    # Screw datetime parsing. ;)
+    return user_data['created_at'][:4]
 
 if __name__ == '__main__':
-    contributors = fetch_contributors(sys.argv[1])
-    for c in contributors:
-        # Get user's stats
-        query_url = "https://api.github.com/users/{0}".format(c["login"])
-        user_data = make_request(query_url)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='Maximum number of concurrent requests')
+    parser.add_argument('--api-url', type=str, default="https://api.github.com", help='GitHub API URL')
+    parser.add_argument('--cache', type=str,
+                        default=os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "github-contributor-stats.json"),
+                        help='Response cache file')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the response cache')
+    parser.add_argument('repos', type=str, nargs='+', help='Repositories (user/repo) or organizations (org:name)')
+    args = parser.parse_args()
+
+    if args.no_cache:
+        cache_path = None
+    else:
+        cache_path = args.cache
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+
+    client = GitHubClient(args.api_url, token=os.getenv("GITHUB_TOKEN"), cache_path=cache_path)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            repos = []
+            for t in args.repos:
+                if t.startswith("org:"):
+                    repos += fetch_org_repos(client, t[4:])
+                else:
+                    repos.append(t)
 
-        # Screw datetime parsing. ;)
-        user_registration_year = user_data['created_at'][:4]
+            if (len(repos) == 1) and (repos == args.repos):
+                # Single repo: the original output format with no header
+                contributors = fetch_contributors(client, repos[0])
+                years = executor.map(lambda c: fetch_registration_year(client, c["login"]), contributors)
+                for c, user_registration_year in zip(contributors, years):
+                    print("{0},{1},{2}".format(c['login'], c['contributions'], user_registration_year))
+            else:
+                # login -> {repo: contributions}
+                contributions = {}
+                for repo, contributors in zip(repos, executor.map(lambda r: fetch_contributors(client, r), repos)):
+                    for c in contributors:
+                        contributions.setdefault(c['login'], {})[repo] = c['contributions']
 
-        print("{0},{1},{2}".format(c['login'], c['contributions'], user_registration_year))
+                logins = sorted(contributions, key=lambda l: sum(contributions[l].values()), reverse=True)
+                years = executor.map(lambda l: fetch_registration_year(client, l), logins)
 
+                print(",".join(["login", "total"] + repos + ["registration_year"]))
+                for login, user_registration_year in zip(logins, years):
+                    per_repo = [str(contributions[login].get(r, 0)) for r in repos]
+                    total = sum(contributions[login].values())
+                    print(",".join([login, str(total)] + per_repo + [user_registration_year]))
+    finally:
+        # Keep whatever was fetched even if the run failed half way
+        client.save_cache()
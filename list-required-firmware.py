@@ -18,88 +18,346 @@
 import re
 import os
 import sys
-import glob
+import mmap
+import json
 import argparse
 import subprocess
+import multiprocessing
 
 # Loads the kernel config -- only options set to y or m
+# Returns a dict of option names to their values, e.g. {"CONFIG_E1000": "m"}
 def load_config(path):
     with open(path, 'r') as f:
         config = f.read()
-    targets = re.findall(r'(.*)=(?:y|m)', config)
-    return targets
+    targets = re.findall(r'^(CONFIG_\w+)=(y|m)\s*$', config, re.MULTILINE)
+    return dict(targets)
 
-# Finds subdir targets from the Makefile
-# that are enabled by the kernel build config
-def find_enabled_subdirs(config, makefile_path):
-    try:
-        with open(makefile_path, 'r') as f:
-            makefile = f.read()
-    except OSError:
-        # Shouldn't happen due to the way collect_source_files()
-        # calls this function.
-        return []
-
-    dir_stmts = re.findall(r'obj-\$\((.*)\)\s+\+=\s+(.*)/(?:\n|$)', makefile)
-    subdirs = []
+# Finds the Kbuild file of a directory, if it has one.
+# Kbuild takes precedence over Makefile if both exist.
+def find_kbuild_file(path):
+    for name in ["Kbuild", "Makefile"]:
+        file_path = os.path.join(path, name)
+        if os.path.exists(file_path):
+            return file_path
+    return None
 
-    for ds in dir_stmts:
-        config_key, src_dir = ds
+class KbuildDir(object):
+    """ Objects and subdirectories of a Kbuild file that are enabled by the config.
 
-        if args.debug:
-            print("Processing make targets from {0} ({1})".format(ds[1], ds[0]), file=sys.stderr)
-        if config_key in config:
-            subdirs.append(src_dir)
-        elif args.debug:
-            print("{0} is disabled in the config, ignoring {1}".format(ds[0], ds[1]), file=sys.stderr)
+        Understands the most common goal definitions:
+          obj-y += foo.o bar/
+          obj-$(CONFIG_FOO) += foo.o \\
+                               baz/
+          foo-objs := a.o b.o
+          foo-y += c.o
+          foo-$(CONFIG_FOO_EXTRA) += d.o
+          subdir-$(CONFIG_FOO) += qux
+
+        Anything more elaborate, like conditionals or computed variable names, is ignored.
+    """
+    def __init__(self, config, makefile_path):
+        # Enabled subdir names
+        self.subdirs = set()
+        # Enabled object paths relative to the dir, including parts of composite objects
+        self.objects = set()
+        # All object paths mentioned in the file
+        self.known_objects = set()
+        # Composite object part -> the composite object it belongs to
+        self.parents = {}
+
+        if makefile_path is None:
+            return
+
+        try:
+            with open(makefile_path, 'r', errors='replace') as f:
+                makefile = f.read()
+        except OSError:
+            return
+
+        # Join continuation lines and drop comments
+        makefile = re.sub(r'\\\n', ' ', makefile)
+        makefile = re.sub(r'#.*', '', makefile)
+
+        # prefix -> list of (enabled, objects and dirs)
+        goals = {}
+        for prefix, cond, words in re.findall(r'^\s*([\w.-]+)-(y|m|objs|\$\(CONFIG_\w+\))\s*(?:\+=|:=|=)\s*(.*)$', makefile, re.MULTILINE):
+            if cond in ['y', 'm', 'objs']:
+                enabled = True
+            else:
+                enabled = cond[2:-1] in config
+                if args.debug and not enabled:
+                    print("{0} is disabled in the config, ignoring {1}".format(cond[2:-1], words.strip()), file=sys.stderr)
+
+            targets = [w for w in words.split() if w.endswith(".o") or w.endswith("/") or (prefix == "subdir")]
+            goals.setdefault(prefix, []).append((enabled, targets))
+            self.known_objects.update([t for t in targets if t.endswith(".o")])
+
+        for prefix in ["obj", "subdir"]:
+            for enabled, targets in goals.get(prefix, []):
+                if not enabled:
+                    continue
+                for t in targets:
+                    if t.endswith(".o"):
+                        self._add_object(goals, t)
+                    else:
+                        self.subdirs.add(t.rstrip("/"))
+
+    def _add_object(self, goals, obj, parent=None):
+        if obj in self.objects:
+            return
+        self.objects.add(obj)
+        if parent is not None:
+            self.parents[obj] = parent
+
+        # Composite object: foo.o is built from the parts listed in foo-objs and foo-y
+        for enabled, targets in goals.get(obj[:-2], []):
+            if enabled:
+                for t in targets:
+                    if t.endswith(".o"):
+                        self._add_object(goals, t, parent=obj)
+
+    # Checks if a source file may be built, given its path relative to the dir.
+    # Files not mentioned in the Kbuild file may still be built through rules we don't understand,
+    # so only files whose objects are mentioned and disabled are excluded.
+    def source_enabled(self, rel_path):
+        obj = re.sub(r'\.c$', '.o', rel_path)
+        return (obj in self.objects) or (obj not in self.known_objects)
+
+class KbuildTree(object):
+    """ Kbuild dirs of a kernel source tree, parsed once and kept for queries """
+    def __init__(self, config):
+        self.config = config
+        self.dirs = {}
 
-    return subdirs
+    def get(self, path):
+        path = os.path.normpath(path)
+        if path not in self.dirs:
+            self.dirs[path] = KbuildDir(self.config, find_kbuild_file(path))
+        return self.dirs[path]
+
+    def enabled_subdirs(self, path):
+        return self.get(path).subdirs
+
+    # Finds the module a source file is built into, e.g. drivers/net/wireless/intel/iwlwifi/mvm/iwlmvm
+    # for drivers/net/wireless/intel/iwlwifi/mvm/fw.c
+    #
+    # Looks for the closest Kbuild file that mentions the file's object,
+    # and follows composite objects up to the top one.
+    # If there's none, the file is assumed to be a single-file module.
+    def module_of(self, source_file):
+        path = os.path.dirname(os.path.normpath(source_file))
+        while True:
+            kbuild_dir = self.get(path)
+            obj = re.sub(r'\.c$', '.o', os.path.relpath(source_file, path))
+            if obj in kbuild_dir.known_objects:
+                while obj in kbuild_dir.parents:
+                    obj = kbuild_dir.parents[obj]
+                return os.path.join(path, obj[:-2])
+
+            parent = os.path.dirname(path)
+            if (parent == path) or (not path):
+                return re.sub(r'\.c$', '', source_file)
+            path = parent
+
+# The cache maps source file paths to their mtime and size at the time of the last run,
+# whether they reference firmware, the config symbols they mention,
+# and the firmware names extracted from them with the values those symbols had.
+#
+# Changes in headers are not tracked, remove the cache after updating the kernel tree.
+def load_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        print("Cache file {0} is malformed, ignoring it".format(path), file=sys.stderr)
+        return {}
+
+def save_cache(path, cache):
+    tmp_path = "{0}.tmp".format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
 
 # For filtering
+#
+# The file is memory-mapped and searched as bytes,
+# so it doesn't need to be decoded or read into a Python string.
+#
+# Returns None if the file doesn't reference firmware,
+# or the list of config symbols it mentions if it does
 def file_loads_firmware(file):
-    with open(file, 'r') as f:
-        source = f.read()
-    if re.search(r'MODULE_FIRMWARE\((.*)\)', source):
-        return True
+    try:
+        with open(file, 'rb') as f:
+            # Empty files can't be mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if m.find(b'MODULE_FIRMWARE(') == -1:
+                    return None
+                symbols = set(re.findall(rb'\bCONFIG_\w+', m))
+                return sorted([s.decode() for s in symbols])
+    except OSError as e:
+        print("Could not read {0}: {1}".format(file, e), file=sys.stderr)
+        return None
 
-# Find all source files that reference firmware
-def collect_source_files(config, path):
-    files = []
+# Worker function for the scan pool, takes a (file, cache entry) tuple.
+# Files whose mtime and size match their cache entry are not read.
+def scan_file(item):
+    file, cached = item
+
+    try:
+        st = os.stat(file)
+    except OSError as e:
+        print("Could not read {0}: {1}".format(file, e), file=sys.stderr)
+        return (file, None)
 
-    makefile = os.path.join(path, "Makefile")
+    if cached and (cached['mtime'] == st.st_mtime_ns) and (cached['size'] == st.st_size):
+        return (file, cached)
+
+    symbols = file_loads_firmware(file)
+    entry = {'mtime': st.st_mtime_ns, 'size': st.st_size,
+             'loads_firmware': symbols is not None, 'symbols': symbols or []}
+    return (file, entry)
+
+# Lists subdirectories and C files of a directory, both sorted
+def scan_dir(path):
+    subdirs = []
+    c_files = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    subdirs.append(entry)
+                elif entry.name.endswith(".c") and entry.is_file():
+                    c_files.append(entry.path)
+    except OSError as e:
+        print("Could not read directory {0}: {1}".format(path, e), file=sys.stderr)
+    return (sorted(subdirs, key=lambda e: e.name), sorted(c_files))
+
+# Finds all C files in a directory and its subdirectories
+def walk_all_c_files(path):
+    subdirs, c_files = scan_dir(path)
+    yield from c_files
+    for d in subdirs:
+        yield from walk_all_c_files(d.path)
+
+# Finds all source files that may be built with the given config
+def walk_source_files(kbuild, path):
+    kbuild_dir = kbuild.get(path)
+    subdirs, c_files = scan_dir(path)
 
     # Find and process all C files in this directory
-    # This is a compromise: sometimes there are single-file modules,
-    # that in fact may be disabled in the config,
-    # so this approach can create occasional false positives.
-    c_files = glob.glob("{0}/*.c".format(path))
-    files = list(filter(file_loads_firmware, c_files))
+    # whose objects are not disabled in the config.
+    # This is still a compromise: files not mentioned in the Kbuild file
+    # are processed too, so this approach can create occasional false positives.
+    for c_file in c_files:
+        if kbuild_dir.source_enabled(os.path.basename(c_file)):
+            yield c_file
+        elif args.debug:
+            print("{0} is disabled in the config, ignoring it".format(c_file), file=sys.stderr)
 
     # Now walk the subdirectories
-    enabled_subdirs = find_enabled_subdirs(config, makefile)
-    subdirs = glob.glob("{0}/*/".format(path))
+    enabled_subdirs = kbuild.enabled_subdirs(path)
     for d in subdirs:
-        dir_name = d.rstrip("/")
-
-        if os.path.exists(os.path.join(d, "Makefile")):
+        if find_kbuild_file(d.path):
             # If there's a makefile, it's an independent module
             # or a high level dir
-            if os.path.basename(dir_name) in enabled_subdirs:
-                files = files + collect_source_files(config, d)
+            if d.name in enabled_subdirs:
+                yield from walk_source_files(kbuild, d.path)
+            elif args.debug:
+                print("{0} is disabled in the config, ignoring it".format(d.path), file=sys.stderr)
         else:
             # It's simply a subdirectory of the current module
             # Some modules, like iwlwifi, keep their firmware-loading files
             # in subdirs, so we have to handle this case
-            c_files = glob.iglob("{0}/**/*.c".format(d), recursive=True)
-            files += list(filter(file_loads_firmware, c_files))
+            for c_file in walk_all_c_files(d.path):
+                if kbuild_dir.source_enabled(os.path.relpath(c_file, path)):
+                    yield c_file
+
+# Find all source files that reference firmware in the given source dirs
+#
+# The directory walk runs in the main process and feeds file names
+# to a pool of workers that search them, results are yielded as they come.
+# All source dirs share the same pool.
+# File cache entries are updated in place.
+def collect_source_files(kbuild, paths, jobs, file_cache=None):
+    if file_cache is None:
+        file_cache = {}
 
-    return files
+    files = ((f, file_cache.get(f)) for path in paths for f in walk_source_files(kbuild, path))
+
+    with multiprocessing.Pool(jobs) as pool:
+        for file, entry in pool.imap(scan_file, files, chunksize=64):
+            if entry is None:
+                continue
+            file_cache[file] = entry
+            if entry['loads_firmware']:
+                yield file
+
+# Preprocesses the source files to get firmware names from MODULE_FIRMWARE macros
+# expanded with the actual config.
+#
+# All .i targets are built by a single make invocation per batch,
+# so that make can run as many jobs in parallel as it's allowed to.
+# With -k, one broken file doesn't stop the rest of the batch.
+#
+# Returns (source file, .i file) tuples for the files that were preprocessed successfully.
+def preprocess_files(source_files, jobs, batch_size=256):
+    targets = [(sf, re.sub(r'\.c$', r'.i', sf)) for sf in source_files]
+
+    # Stale .i files would hide failures
+    for _, i_file in targets:
+        try:
+            os.remove(i_file)
+        except FileNotFoundError:
+            pass
+
+    preprocessed = []
+    for n in range(0, len(targets), batch_size):
+        batch = targets[n:n + batch_size]
+        res = subprocess.run(["make", "-k", "-j{0}".format(jobs)] + [i for _, i in batch],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        failed = []
+        for sf, i_file in batch:
+            if os.path.exists(i_file):
+                preprocessed.append((sf, i_file))
+            else:
+                failed.append(sf)
+
+        if failed or (res.returncode != 0):
+            for sf in failed:
+                print("Failed to preprocess file {0}".format(sf), file=sys.stderr)
+            print(res.stdout.decode(errors='replace'), file=sys.stderr)
+
+    return preprocessed
+
+# Returns the config values relevant to a source file, for comparing with the cache
+def config_values(config, symbols):
+    return ["{0}={1}".format(s, config[s]) for s in symbols if s in config]
+
+# Extracts firmware names from a preprocessed file.
+# The file is read line by line rather than all at once, .i files can be quite big.
+def extract_firmware(i_file):
+    fw_files = []
+    with open(i_file, 'r', errors='replace') as f:
+        for line in f:
+            if '__UNIQUE_ID_firmware' not in line:
+                continue
+            fw_statements = re.findall(r'__UNIQUE_ID_firmware.*"firmware"\s+"="\s+(.*);', line)
+            fw_files += list(map(lambda s: re.sub(r'(\s|")', r'', s), fw_statements))
+    return fw_files
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--source-dir", action="append", help="Kernel source directory to process", required=True)
     parser.add_argument("-c", "--kernel-config", action="store", help="Kernel configuration")
     parser.add_argument("-d", "--debug", action="store_true", help="Enable Debug output")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of parallel jobs")
+    parser.add_argument("--cache", action="store", help="Cache file for per-file results")
+    parser.add_argument("--json", action="store_true", help="Output a JSON object that maps firmware names to modules that need them")
     parser.add_argument("-f", "--list-source-files", action="store_true", help="List source files that reference firmware and exit")
     args = parser.parse_args()
 
@@ -107,27 +365,50 @@ if __name__ == '__main__':
         args.kernel_config = ".config"
 
     config = load_config(args.kernel_config)
+    kbuild = KbuildTree(config)
+
+    if args.cache:
+        cache = load_cache(args.cache)
+    else:
+        cache = {}
+    file_cache = cache.setdefault('files', {})
 
     # Collect source files that reference firmware
-    for directory in args.source_dir:
-        source_files = collect_source_files(config, directory)
+    # The same file can be reached from overlapping source dirs
+    source_files = list(dict.fromkeys(collect_source_files(kbuild, args.source_dir, args.jobs, file_cache)))
 
     if args.list_source_files:
         for sf in source_files:
             print(sf)
     else:
-        fw_files = []
+        # Files whose relevant config symbols have the same values as last time
+        # don't need to be preprocessed again
+        fw_by_file = {}
+        to_preprocess = []
         for sf in source_files:
-            i_file = re.sub(r'\.c', r'.i', sf)
-            res = subprocess.run(["make {0} 2>&1".format(i_file)], shell=True, capture_output=True)
-            if res.returncode != 0:
-                print("Failed to preprocess file {0}".format(sf), file=sys.stderr)
-                print(res.stdout.decode(), file=sys.stderr)
+            entry = file_cache[sf]
+            values = config_values(config, entry['symbols'])
+            if ('firmware' in entry) and (entry['config_values'] == values):
+                fw_by_file[sf] = entry['firmware']
             else:
-                with open(i_file, 'r') as f:
-                    source = f.read()
-                    fw_statements = re.findall(r'__UNIQUE_ID_firmware.*"firmware"\s+"="\s+(.*);', source)
-                    fw_files += list(map(lambda s: re.sub(r'(\s|")', r'', s), fw_statements))
+                to_preprocess.append(sf)
+
+        for sf, i_file in preprocess_files(to_preprocess, args.jobs):
+            fw_by_file[sf] = extract_firmware(i_file)
+            file_cache[sf]['firmware'] = fw_by_file[sf]
+            file_cache[sf]['config_values'] = config_values(config, file_cache[sf]['symbols'])
+
+        # Firmware name -> set of modules
+        fw_files = {}
+        for sf in source_files:
+            for fw in fw_by_file.get(sf, []):
+                fw_files.setdefault(fw, set()).add(kbuild.module_of(sf))
+
+        if args.json:
+            print(json.dumps({fw: sorted(fw_files[fw]) for fw in sorted(fw_files)}, indent=2))
+        else:
+            for fw in sorted(fw_files):
+                print(fw)
 
-        for fw in fw_files:
-            print(fw)
+    if args.cache:
+        save_cache(args.cache, cache)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+#
+# Microbenchmarks for maya_timestamp.py
+#
+# Measures single conversions (each MayaDate method separately),
+# bulk conversions, module import time, and memory per MayaDate object,
+# and writes the results as JSON, so that they can be compared across changes.
+#
+# Usage: maya_timestamp-bench.py [-n COUNT] [-o results.json]
+#
+# Copyright (c) 2013 Daniil Baturin <daniil at baturin dot org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import subprocess
+import statistics
+import tracemalloc
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, script_dir)
+
+import maya_timestamp
+from maya_timestamp import MayaDate
+
+# Returns the best time per call in microseconds
+def time_per_call(stmt, number, repeat=5):
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number * 1e6
+
+# Returns the median import time of the module in milliseconds, as reported by -X importtime,
+# so the interpreter startup time is not included
+def import_time(runs=10):
+    times = []
+    for _ in range(runs):
+        res = subprocess.run([sys.executable, "-X", "importtime", "-c", "import maya_timestamp"],
+                             cwd=script_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        # The last line is the module itself, its cumulative time includes all its imports
+        last = res.stderr.decode().strip().splitlines()[-1]
+        times.append(int(last.split("|")[1]) / 1000)
+    return statistics.median(times)
+
+def memory_per_object(count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    dates = [MayaDate(i * MayaDate.seconds_in_day) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del dates
+    return (after - before) / count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=100000, help='Number of conversions per measurement')
+    parser.add_argument('-o', '--output', type=str, help='Output file (default: stdout)')
+    args = parser.parse_args()
+
+    timestamp = 1700000000
+    date = MayaDate(timestamp)
+
+    results = {}
+    results["numpy"] = maya_timestamp.numpy is not None
+
+    # Single conversions, microseconds per call.
+    # Formatted strings are cached in MayaDate objects, so every call gets a new object.
+    results["single_us"] = {
+        "construct": time_per_call(lambda: MayaDate(timestamp), args.count),
+        "long_count_date": time_per_call(lambda: MayaDate(timestamp).long_count_date(), args.count),
+        "tzolkin_date": time_per_call(lambda: MayaDate(timestamp).tzolkin_date(), args.count),
+        "haab_date": time_per_call(lambda: MayaDate(timestamp).haab_date(), args.count),
+        "date": time_per_call(lambda: MayaDate(timestamp).date(), args.count),
+        "date_cached": time_per_call(lambda: date.date(), args.count),
+    }
+
+    # Bulk conversions, total milliseconds for the whole batch
+    timestamps = [timestamp + i * 3600 for i in range(args.count)]
+    if maya_timestamp.numpy is not None:
+        timestamps = maya_timestamp.numpy.array(timestamps)
+    results["bulk_count"] = args.count
+    results["bulk_ms"] = {
+        "bulk_convert": time_per_call(lambda: maya_timestamp.bulk_convert(timestamps), 1) / 1000,
+        "bulk_convert_and_format": time_per_call(lambda: maya_timestamp.bulk_format(maya_timestamp.bulk_convert(timestamps)), 1) / 1000,
+    }
+
+    results["import_ms"] = import_time()
+    results["bytes_per_object"] = memory_per_object(args.count)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -22,6 +22,12 @@
 
 import sys
 
+# NumPy is optional, it's only used for bulk conversion
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class MayaDate(object):
     """ Converts number of days since UNIX epoch
         to the Maya calendar date.
@@ -68,28 +74,29 @@ class MayaDate(object):
         of tzolk'in.
 
         Every day of the 20 day cycle has unique name, we number
-        them from zero so it's easier to map remainder to day:
+        them from zero so it's easier to map remainder to day,
+        the names are in a tuple indexed by the remainder:
     """
-    tzolkin_days = { 0: "Imix'",
-                     1: "Ik'",
-                     2: "Ak'b'al",
-                     3: "K'an",
-                     4: "Chikchan",
-                     5: "Kimi",
-                     6: "Manik'",
-                     7: "Lamat",
-                     8: "Muluk",
-                     9: "Ok",
-                    10: "Chuwen",
-                    11: "Eb'",
-                    12: "B'en",
-                    13: "Ix",
-                    14: "Men",
-                    15: "Kib'",
-                    16: "Kab'an",
-                    17: "Etz'nab'",
-                    18: "Kawak",
-                    19: "Ajaw" }
+    tzolkin_days = ( "Imix'",     # 0
+                     "Ik'",       # 1
+                     "Ak'b'al",   # 2
+                     "K'an",      # 3
+                     "Chikchan",  # 4
+                     "Kimi",      # 5
+                     "Manik'",    # 6
+                     "Lamat",     # 7
+                     "Muluk",     # 8
+                     "Ok",        # 9
+                     "Chuwen",    # 10
+                     "Eb'",       # 11
+                     "B'en",      # 12
+                     "Ix",        # 13
+                     "Men",       # 14
+                     "Kib'",      # 15
+                     "Kab'an",    # 16
+                     "Etz'nab'",  # 17
+                     "Kawak",     # 18
+                     "Ajaw" )     # 19
 
     """ As said above, haab (year) has 19 months. Only 18 are
         true months of 20 days each, the remaining 5 days  called "wayeb"
@@ -99,25 +106,25 @@ class MayaDate(object):
         Also, note that days of the month are actually numbered from 0, not from 1,
         it's not for technical reasons.
     """
-    haab_months = { 0: "Pop",
-                    1: "Wo'",
-                    2: "Sip",
-                    3: "Sotz'",
-                    4: "Sek",
-                    5: "Xul",
-                    6: "Yaxk'in'",
-                    7: "Mol",
-                    8: "Ch'en",
-                    9: "Yax",
-                   10: "Sak'",
-                   11: "Keh",
-                   12: "Mak",
-                   13: "K'ank'in",
-                   14: "Muwan'",
-                   15: "Pax",
-                   16: "K'ayab",
-                   17: "Kumk'u",
-                   18: "Wayeb'" }
+    haab_months = ( "Pop",       # 0
+                    "Wo'",       # 1
+                    "Sip",       # 2
+                    "Sotz'",     # 3
+                    "Sek",       # 4
+                    "Xul",       # 5
+                    "Yaxk'in'",  # 6
+                    "Mol",       # 7
+                    "Ch'en",     # 8
+                    "Yax",       # 9
+                    "Sak'",      # 10
+                    "Keh",       # 11
+                    "Mak",       # 12
+                    "K'ank'in",  # 13
+                    "Muwan'",    # 14
+                    "Pax",       # 15
+                    "K'ayab",    # 16
+                    "Kumk'u",    # 17
+                    "Wayeb'" )   # 18
 
     """ Now we need to map the beginning of UNIX epoch
         (Jan 1 1970 00:00 UTC) to the beginning of the long count
@@ -131,85 +138,299 @@ class MayaDate(object):
         starts on 12.17.16.7.5, 13 Chikchan, 3 K'ank'in
 
         It's known as Goodman-Martinez-Thompson (GMT) correlation
-        constant.
+        constant. The constant is the Julian day number of 0.0.0.0.0,
+        584283 in the original GMT correlation. Some researchers prefer
+        584285 or other values, so it can be passed to the constructor.
+
+        start_days is the number of days from 0.0.0.0.0 to the UNIX epoch,
+        whose Julian day number is 2440588.
     """
-    start_days = 1856305
+    gmt_correlation = 584283
+    unix_epoch_jdn = 2440588
+    start_days = unix_epoch_jdn - gmt_correlation
 
     """ Seconds in day, for conversion from timestamp """
     seconds_in_day = 60 * 60 * 24
       
-    def __init__(self, timestamp):
-        if timestamp is None:
-            self.days = self.start_days
-        else:
-            self.days = self.start_days + (int(timestamp) // self.seconds_in_day)
+    """ Dates are immutable and all components are computed once, in the constructor.
+        Formatted strings are cached on first use.
 
-    def long_count_date(self):
-        """ Returns long count date string """
-        days = self.days
+        With __slots__, instances have no __dict__, so millions of them
+        can be kept in memory.
+    """
+    __slots__ = ('correlation', 'days', 'long_count', 'tzolkin', 'haab',
+                 '_long_count_string', '_tzolkin_string', '_haab_string')
 
-        cur_baktun = days // self.baktun
-        days = days % self.baktun
+    @classmethod
+    def epoch_days(cls, correlation=None):
+        """ Returns the number of days from 0.0.0.0.0 to the UNIX epoch for a correlation constant """
+        if correlation is None:
+            return cls.start_days
+        return cls.unix_epoch_jdn - correlation
 
-        cur_katun = days // self.katun
-        days = days % self.katun
+    def __init__(self, timestamp, correlation=None):
+        set_attr = super(MayaDate, self).__setattr__
 
-        cur_tun = days // self.tun
-        days = days % self.tun
+        if correlation is None:
+            correlation = self.gmt_correlation
+        start_days = self.epoch_days(correlation)
 
-        cur_winal = days // self.winal
-        days = days % self.winal
+        if timestamp is None:
+            days = start_days
+        else:
+            days = start_days + (int(timestamp) // self.seconds_in_day)
 
-        cur_kin = days
+        set_attr('correlation', correlation)
+        set_attr('days', days)
 
-        longcount_string = "{0}.{1}.{2}.{3}.{4}".format( cur_baktun, 
-                                                cur_katun,
-                                                cur_tun,
-                                                cur_winal,
-                                                cur_kin )
-        return(longcount_string)
+        """ (baktun, katun, tun, winal, kin) """
+        cur_baktun, days = divmod(days, self.baktun)
+        cur_katun, days = divmod(days, self.katun)
+        cur_tun, days = divmod(days, self.tun)
+        cur_winal, cur_kin = divmod(days, self.winal)
+        set_attr('long_count', (cur_baktun, cur_katun, cur_tun, cur_winal, cur_kin))
 
-    def tzolkin_date(self):
-        """ Returns tzolkin date string """
-        days = self.days
+        """ (day number, day name index)
 
-        """ The start date is not the beginning of both cycles,
+            The start date is not the beginning of both cycles,
             it's 4 Ajaw. So we need to add 4 to the 13 days cycle day,
             and substract 1 from the 20 day cycle to get correct result.
-        """
-        tzolkin_13 = (days + 4) % 13
-        tzolkin_20 = (days - 1) % 20
-
-        tzolkin_string = "{0} {1}".format(tzolkin_13, self.tzolkin_days[tzolkin_20])
 
-        return(tzolkin_string)
+            The 13 day cycle is numbered from 1 to 13, so the remainder 0 is 13.
+        """
+        set_attr('tzolkin', ((self.days + 3) % 13 + 1, (self.days - 1) % 20))
 
-    def haab_date(self):
-        """ Returns haab date string.
+        """ (day of month, month index)
 
             The time start on 8 Kumk'u rather than 0 Pop, which is
             17 days before the new haab, so we need to substract 17
             from the current date to get correct result.
         """
-        days = self.days
+        haab_month, haab_day_of_month = divmod((self.days - 17) % 365, 20)
+        set_attr('haab', (haab_day_of_month, haab_month))
 
-        haab_day = (days - 17) % 365
-        haab_month = haab_day // 20
-        haab_day_of_month = haab_day % 20
+        set_attr('_long_count_string', None)
+        set_attr('_tzolkin_string', None)
+        set_attr('_haab_string', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MayaDate objects are immutable")
 
-        haab_string =  "{0} {1}".format(haab_day_of_month, self.haab_months[haab_month])
+    def __eq__(self, other):
+        return isinstance(other, MayaDate) and (self.days == other.days)
 
-        return(haab_string)
+    def __hash__(self):
+        return hash(self.days)
+
+    def __repr__(self):
+        return "MayaDate({0})".format(self.date())
+
+    def long_count_date(self):
+        """ Returns long count date string """
+        if self._long_count_string is None:
+            super(MayaDate, self).__setattr__('_long_count_string', "{0}.{1}.{2}.{3}.{4}".format(*self.long_count))
+        return self._long_count_string
+
+    def tzolkin_date(self):
+        """ Returns tzolkin date string """
+        if self._tzolkin_string is None:
+            tzolkin_13, tzolkin_20 = self.tzolkin
+            super(MayaDate, self).__setattr__('_tzolkin_string', "{0} {1}".format(tzolkin_13, self.tzolkin_days[tzolkin_20]))
+        return self._tzolkin_string
+
+    def haab_date(self):
+        """ Returns haab date string """
+        if self._haab_string is None:
+            haab_day_of_month, haab_month = self.haab
+            super(MayaDate, self).__setattr__('_haab_string', "{0} {1}".format(haab_day_of_month, self.haab_months[haab_month]))
+        return self._haab_string
 
     def date(self):
         return("{0}, {1}, {2}".format( self.long_count_date(), self.tzolkin_date(), self.haab_date() ))
 
-try: 
-    timestamp = sys.argv[1]
-except:
-    print("Please specify timestamp in the argument")
-    sys.exit(1)
+def bulk_convert(timestamps, correlation=None):
+    """ Converts many UNIX timestamps at once.
+
+        Takes a NumPy array or any iterable of timestamps, returns a dict
+        of component arrays (or lists, if NumPy is not available):
+          baktun, katun, tun, winal, kin -- long count date,
+          tzolkin_number, tzolkin_day -- tzolk'in day number and day name index,
+          haab_day, haab_month -- haab day of month and month index.
+
+        Name indices are indices of MayaDate.tzolkin_days and MayaDate.haab_months.
+    """
+    start_days = MayaDate.epoch_days(correlation)
+
+    if numpy is not None:
+        days = start_days + numpy.floor_divide(numpy.asarray(timestamps, dtype=numpy.int64), MayaDate.seconds_in_day)
+        # Division is much faster on 32-bit integers,
+        # and day numbers only exceed their range millions of years from now
+        if (days.size > 0) and (days.min() > -2**31) and (days.max() < 2**31):
+            days = days.astype(numpy.int32)
+        divmod_ = numpy.divmod
+    else:
+        days = [start_days + (int(t) // MayaDate.seconds_in_day) for t in timestamps]
+        divmod_ = lambda xs, n: ([x // n for x in xs], [x % n for x in xs])
+
+    # Same arithmetic as in MayaDate methods, applied to whole arrays
+    components = {}
+    rest = days
+    for name, length in [("baktun", MayaDate.baktun), ("katun", MayaDate.katun),
+                         ("tun", MayaDate.tun), ("winal", MayaDate.winal)]:
+        components[name], rest = divmod_(rest, length)
+    components["kin"] = rest
+
+    if numpy is not None:
+        components["tzolkin_number"] = (days + 3) % 13 + 1
+        components["tzolkin_day"] = (days - 1) % 20
+        haab_day = (days - 17) % 365
+    else:
+        components["tzolkin_number"] = [(d + 3) % 13 + 1 for d in days]
+        components["tzolkin_day"] = [(d - 1) % 20 for d in days]
+        haab_day = [(d - 17) % 365 for d in days]
+    components["haab_month"], components["haab_day"] = divmod_(haab_day, 20)
+
+    return components
+
+def bulk_format(components):
+    """ Formats the output of bulk_convert() as date strings, like MayaDate.date() """
+    tzolkin_days = MayaDate.tzolkin_days
+    haab_months = MayaDate.haab_months
+    return ["{0}.{1}.{2}.{3}.{4}, {5} {6}, {7} {8}".format(b, k, t, w, n, tn, tzolkin_days[td], hd, haab_months[hm])
+            for b, k, t, w, n, tn, td, hd, hm in zip(*[components[c] for c in
+                ["baktun", "katun", "tun", "winal", "kin", "tzolkin_number", "tzolkin_day", "haab_day", "haab_month"]])]
+
+def convert_stream(infile, outfile, chunk_size=65536, correlation=None):
+    """ Reads timestamps from a file, one per line, and writes Maya dates in the same order.
+        Lines are converted in chunks, so memory use doesn't depend on the input size.
+    """
+    while True:
+        lines = infile.readlines(chunk_size)
+        if not lines:
+            break
+        timestamps = [l.strip() for l in lines if l.strip()]
+        if numpy is None:
+            timestamps = list(map(int, timestamps))
+        dates = bulk_format(bulk_convert(timestamps, correlation))
+        if dates:
+            outfile.write("\n".join(dates))
+            outfile.write("\n")
+
+def long_count_to_timestamp(long_count, correlation=None):
+    """ Converts a long count date string like "13.0.0.0.0"
+        to the UNIX timestamp of the beginning of that day
+    """
+    parts = long_count.strip().split(".")
+    if len(parts) != 5:
+        raise ValueError("Long count date must have five components: {0}".format(long_count))
+
+    days = 0
+    for part, length in zip(parts, [MayaDate.baktun, MayaDate.katun, MayaDate.tun, MayaDate.winal, MayaDate.kin]):
+        days += int(part) * length
 
-maya_date = MayaDate(timestamp)
-print(maya_date.date())
+    return (days - MayaDate.epoch_days(correlation)) * MayaDate.seconds_in_day
 
+def _lookup_name(names, name):
+    for k, n in enumerate(names):
+        if n.lower() == name.lower():
+            return k
+    raise ValueError("Unknown day or month name: {0}".format(name))
+
+def _crt(a1, m1, a2, m2):
+    """ Solves x = a1 (mod m1), x = a2 (mod m2) for moduli that are not necessarily coprime.
+        Returns (x, lcm(m1, m2)), or None if there's no solution.
+    """
+    # Extended Euclid: g = gcd(m1, m2) = p * m1 + q * m2
+    old_r, r = m1, m2
+    old_p, p = 1, 0
+    while r != 0:
+        quotient = old_r // r
+        old_r, r = r, old_r - quotient * r
+        old_p, p = p, old_p - quotient * p
+    g = old_r
+
+    if (a2 - a1) % g != 0:
+        return None
+
+    lcm = m1 // g * m2
+    x = (a1 + (a2 - a1) // g * old_p % (m2 // g) * m1) % lcm
+    return (x, lcm)
+
+def find_calendar_round(tzolkin, haab, start_timestamp, end_timestamp, correlation=None):
+    """ Finds all days in the given range that have the given
+        tzolk'in and haab dates, e.g. "4 Ajaw" and "8 Kumk'u".
+
+        Any combination repeats every 18980 days (about 52 years),
+        the calendar round, so we find its position in the round
+        with the Chinese remainder theorem and step by whole rounds.
+
+        Returns UNIX timestamps of the beginnings of matching days.
+    """
+    tzolkin_number, tzolkin_name = tzolkin.strip().split(" ", 1)
+    tzolkin_number = int(tzolkin_number)
+    tzolkin_day = _lookup_name(MayaDate.tzolkin_days, tzolkin_name.strip())
+    if not (1 <= tzolkin_number <= 13):
+        raise ValueError("Tzolk'in day number must be from 1 to 13")
+
+    haab_day, haab_month_name = haab.strip().split(" ", 1)
+    haab_day = int(haab_day)
+    haab_month = _lookup_name(MayaDate.haab_months, haab_month_name.strip())
+    month_length = 5 if haab_month == 18 else 20
+    if not (0 <= haab_day < month_length):
+        raise ValueError("Day of {0} must be from 0 to {1}".format(MayaDate.haab_months[haab_month], month_length - 1))
+
+    # Inverse of the formulas in MayaDate.tzolkin_date() and MayaDate.haab_date()
+    congruences = [((tzolkin_number - 4) % 13, 13),
+                   ((tzolkin_day + 1) % 20, 20),
+                   ((haab_month * 20 + haab_day + 17) % 365, 365)]
+
+    day, period = congruences[0]
+    for a, m in congruences[1:]:
+        res = _crt(day, period, a, m)
+        if res is None:
+            # Not every combination exists, e.g. tzolk'in Imix' never falls on haab day 0
+            return []
+        day, period = res
+
+    epoch_days = MayaDate.epoch_days(correlation)
+    start_days = epoch_days + start_timestamp // MayaDate.seconds_in_day
+    end_days = epoch_days + end_timestamp // MayaDate.seconds_in_day
+    first = start_days + (day - start_days) % period
+
+    return [(d - epoch_days) * MayaDate.seconds_in_day for d in range(first, end_days + 1, period)]
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--correlation', type=int, default=MayaDate.gmt_correlation, help='Correlation constant (default: 584283, GMT)')
+    parser.add_argument('--from-long-count', type=str, help='Convert a long count date to a UNIX timestamp')
+    parser.add_argument('--find', type=str, nargs=2, metavar=('TZOLKIN', 'HAAB'),
+                        help='Find days with given tzolk\'in and haab dates, e.g. --find "4 Ajaw" "8 Kumk\'u"')
+    parser.add_argument('--start', type=int, help='Search range start timestamp (default: 0.0.0.0.0)')
+    parser.add_argument('--end', type=int, help='Search range end timestamp (default: 20.0.0.0.0)')
+    parser.add_argument('timestamp', type=str, nargs='?', help='UNIX timestamp, or - to read timestamps from stdin')
+    args = parser.parse_args()
+
+    if args.start is None:
+        args.start = long_count_to_timestamp("0.0.0.0.0", args.correlation)
+    if args.end is None:
+        args.end = long_count_to_timestamp("20.0.0.0.0", args.correlation)
+
+    try:
+        if args.from_long_count:
+            print(long_count_to_timestamp(args.from_long_count, args.correlation))
+        elif args.find:
+            for t in find_calendar_round(args.find[0], args.find[1], args.start, args.end, args.correlation):
+                print("{0} {1}".format(t, MayaDate(t, args.correlation).date()))
+        elif args.timestamp == "-":
+            convert_stream(sys.stdin, sys.stdout, correlation=args.correlation)
+        elif args.timestamp is not None:
+            maya_date = MayaDate(args.timestamp, args.correlation)
+            print(maya_date.date())
+        else:
+            print("Please specify timestamp in the argument, or - to read timestamps from stdin")
+            sys.exit(1)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
@@ -8,9 +8,26 @@
 # which is 2x of the real cores if SMT is enabled.
 #
 # The idea is to find all physical CPUs and add up their core counts.
-# It has special cases for x86_64 and MAY work correctly on other architectures,
+# The topology is read from sysfs (/sys/devices/system/cpu/cpu*/topology),
+# which works the same way on all architectures.
+# If sysfs is not available, it falls back to /proc/cpuinfo,
+# which has special cases for x86_64 and MAY work correctly on other architectures,
 # but nothing is certain.
 #
+# With --topology, it prints the number of sockets, physical cores, threads,
+# and NUMA nodes as JSON.
+#
+# With --effective, it prints the number of CPUs the process can actually use,
+# which is limited by its CPU affinity and by cgroup (v1 or v2) CPU quota and cpuset,
+# e.g. inside containers. That is the number to use for sizing worker pools.
+# From Python, use effective_cpu_count().
+#
+# With --sample INTERVAL, it reads /proc/stat every INTERVAL seconds and prints
+# the utilization of every logical CPU and every physical core (all its SMT siblings together)
+# as JSON lines, e.g. to find hot cores and cores whose siblings compete for them.
+# The sysfs and procfs locations can be changed with --sysfs-root and --proc-root,
+# e.g. to check it against a fake sysfs tree, and so can the cgroup mount point (--cgroup-root).
+#
 # Copyright (c) 2022 Daniil Baturin <daniil at baturin dot org>
 #
 # Permission is hereby granted, free of charge, to any person obtaining a copy
@@ -32,63 +49,404 @@
 # THE SOFTWARE.
 
 
+import os
 import re
+import sys
+import math
+import json
+import time
+import argparse
+
+
+# Parses the CPU list format used by the kernel, e.g. "0-3,8,10-11"
+def parse_cpu_list(s):
+    cpus = []
+    s = s.strip()
+    if not s:
+        return cpus
+
+    for part in s.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus += range(int(first), int(last) + 1)
+        else:
+            cpus.append(int(part))
+
+    return cpus
 
+def read_file(path):
+    with open(path, 'r') as f:
+        return f.read().strip()
 
-def read_cpuinfo():
-    with open('/proc/cpuinfo', 'r') as f:
+def read_cpuinfo(proc_root='/proc'):
+    with open(os.path.join(proc_root, 'cpuinfo'), 'r') as f:
         return f.readlines()
 
 def split_line(l):
-    l = l.strip()
-    parts = re.split(r'\s*:\s*', l)
-    return (parts[0], ":".join(parts[1:]))
+    key, _, value = l.partition(':')
+    return (key.strip(), value.strip())
 
 def find_cpus(cpuinfo_lines):
     cpus = {}
 
-    cpu_number = 0
+    cpu_number = None
 
     for l in cpuinfo_lines:
         key, value = split_line(l)
-        if key == 'processor':
-            cpu_number = value
+        if not key:
+            # Empty lines between processors
+            continue
+        elif key == 'processor':
+            cpu_number = int(value)
             cpus[cpu_number] = {}
-        else:
+        elif cpu_number is not None:
+            # Some architectures have system-wide fields before the first processor,
+            # e.g. "Processor" on 32-bit ARM, they are ignored.
             cpus[cpu_number][key] = value
 
     return cpus
 
-def find_physical_cpus(cpus):
-    phys_cpus = {}
+# Returns a dict of logical CPU numbers to NUMA node numbers,
+# or an empty dict if the kernel has no NUMA support
+def read_numa_nodes(sysfs_root='/sys'):
+    node_dir = os.path.join(sysfs_root, 'devices/system/node')
+    nodes = {}
+
+    try:
+        entries = os.listdir(node_dir)
+    except OSError:
+        return nodes
+
+    for e in entries:
+        if re.fullmatch(r'node\d+', e):
+            node = int(e[4:])
+            for cpu in parse_cpu_list(read_file(os.path.join(node_dir, e, 'cpulist'))):
+                nodes[cpu] = node
+
+    return nodes
+
+class CPUTopology(object):
+    """ Maps online logical CPUs to physical cores, packages (sockets) and NUMA nodes.
+
+        Cores are identified by (package, die, core id) tuples,
+        since core ids are only unique within a die.
+    """
+    def __init__(self, cpus):
+        # Logical CPU number -> (package, core, NUMA node)
+        self.cpus = cpus
+
+    # Returns None if sysfs has no topology data
+    @classmethod
+    def from_sysfs(cls, sysfs_root='/sys'):
+        cpu_dir = os.path.join(sysfs_root, 'devices/system/cpu')
+
+        try:
+            online = parse_cpu_list(read_file(os.path.join(cpu_dir, 'online')))
+        except OSError:
+            return None
 
-    for num in cpus:
-        if 'physical id' in cpus[num]:
+        nodes = read_numa_nodes(sysfs_root)
+
+        cpus = {}
+        for cpu in online:
+            topology_dir = os.path.join(cpu_dir, 'cpu{0}'.format(cpu), 'topology')
+            try:
+                package = int(read_file(os.path.join(topology_dir, 'physical_package_id')))
+                core_id = int(read_file(os.path.join(topology_dir, 'core_id')))
+            except OSError:
+                return None
+
+            # Only available on x86 with kernels newer than 5.2
+            try:
+                die = int(read_file(os.path.join(topology_dir, 'die_id')))
+            except OSError:
+                die = 0
+
+            # Some ARM systems report -1 when there is no package information
+            package = max(package, 0)
+            cpus[cpu] = (package, (package, die, core_id), nodes.get(cpu, 0))
+
+        return cls(cpus)
+
+    @classmethod
+    def from_cpuinfo(cls, cpuinfo_lines, nodes=None):
+        if nodes is None:
+            nodes = {}
+
+        cpus = {}
+
+        for num, fields in find_cpus(cpuinfo_lines).items():
             # On at least some architectures, CPUs in different sockets
             # have different 'physical id' field, e.g. on x86_64.
-            phys_id = cpus[num]['physical id']
-            if phys_id not in phys_cpus:
-                phys_cpus[phys_id] = cpus[num]
-        else:
             # On other architectures, e.g. on ARM, there's no such field.
             # We just assume they are different CPUs,
             # whether single core ones or cores of physical CPUs.
-            phys_cpus[num] = cpu[num]
+            package = int(fields.get('physical id', 0))
+            core_id = int(fields.get('core id', num))
+            cpus[num] = (package, (package, 0, core_id), nodes.get(num, 0))
 
-    return phys_cpus
+        return cls(cpus)
 
+    @classmethod
+    def detect(cls, sysfs_root='/sys', proc_root='/proc'):
+        topology = cls.from_sysfs(sysfs_root)
+        if topology is None:
+            topology = cls.from_cpuinfo(read_cpuinfo(proc_root), read_numa_nodes(sysfs_root))
+        return topology
 
-if __name__ == '__main__':
-    physical_cpus = find_physical_cpus(find_cpus(read_cpuinfo()))
+    def sockets(self):
+        return len(set(c[0] for c in self.cpus.values()))
 
-    core_count = 0
+    def cores(self):
+        return len(set(c[1] for c in self.cpus.values()))
 
-    for num in physical_cpus:
-        # Some architectures, e.g. x86_64, include a field for core count.
-        # Since we found unique physical CPU entries, we can sum their core counts.
-        if 'cpu cores' in physical_cpus[num]:
-            core_count += int(physical_cpus[num]['cpu cores'])
-        else:
-            core_count += 1
+    def threads(self):
+        return len(self.cpus)
+
+    def numa_nodes(self):
+        return len(set(c[2] for c in self.cpus.values()))
+
+    # Returns a dict of cores to the lists of their logical CPUs (SMT siblings)
+    def siblings(self):
+        cores = {}
+        for cpu in sorted(self.cpus):
+            cores.setdefault(self.cpus[cpu][1], []).append(cpu)
+        return cores
+
+    def summary(self):
+        return {"sockets": self.sockets(), "cores": self.cores(),
+                "threads": self.threads(), "numa_nodes": self.numa_nodes()}
+
+# Returns a dict of cgroup controllers to cgroup paths of the current process.
+# The unified (v2) hierarchy has an empty controller name.
+def read_cgroups(proc_root='/proc'):
+    cgroups = {}
+
+    try:
+        lines = read_file(os.path.join(proc_root, 'self/cgroup')).splitlines()
+    except OSError:
+        return cgroups
+
+    for l in lines:
+        _, controllers, path = l.split(':', 2)
+        for c in controllers.split(','):
+            cgroups[c] = path
+
+    return cgroups
+
+# Returns the existing directories of a cgroup and its ancestors, innermost first.
+# Inside a container, the path from /proc/self/cgroup may belong to the host hierarchy
+# and not exist under the container's cgroup mount, then only the mount point itself is left.
+def cgroup_dirs(mount, path):
+    parts = [p for p in path.split('/') if p]
+    dirs = []
+    for i in range(len(parts), -1, -1):
+        d = os.path.join(mount, *parts[:i])
+        if os.path.isdir(d):
+            dirs.append(d)
+    return dirs
+
+# Returns the quota in CPUs (e.g. 1.5), or None if there is no quota.
+# A cgroup cannot use more than any of its ancestors, so the smallest quota wins.
+def cpu_quota(cgroup_root, cgroups, unified):
+    quotas = []
+
+    if unified:
+        for d in cgroup_dirs(cgroup_root, cgroups.get('', '/')):
+            try:
+                quota, period = read_file(os.path.join(d, 'cpu.max')).split()
+            except (OSError, ValueError):
+                continue
+            if quota != 'max':
+                quotas.append(int(quota) / int(period))
+    elif 'cpu' in cgroups:
+        mount = os.path.join(cgroup_root, 'cpu')
+        if not os.path.isdir(mount):
+            mount = os.path.join(cgroup_root, 'cpu,cpuacct')
+        for d in cgroup_dirs(mount, cgroups['cpu']):
+            try:
+                quota = int(read_file(os.path.join(d, 'cpu.cfs_quota_us')))
+                period = int(read_file(os.path.join(d, 'cpu.cfs_period_us')))
+            except (OSError, ValueError):
+                continue
+            # -1 means no quota
+            if quota > 0:
+                quotas.append(quota / period)
+
+    return min(quotas) if quotas else None
+
+# Returns the number of CPUs in the cgroup's cpuset, or None if it's unknown.
+# Effective cpusets already take the ancestors into account.
+def cpuset_size(cgroup_root, cgroups, unified):
+    if unified:
+        dirs = cgroup_dirs(cgroup_root, cgroups.get('', '/'))
+        names = ['cpuset.cpus.effective']
+    elif 'cpuset' in cgroups:
+        dirs = cgroup_dirs(os.path.join(cgroup_root, 'cpuset'), cgroups['cpuset'])
+        names = ['cpuset.effective_cpus', 'cpuset.cpus']
+    else:
+        return None
+
+    for d in dirs:
+        for n in names:
+            try:
+                cpus = parse_cpu_list(read_file(os.path.join(d, n)))
+            except (OSError, ValueError):
+                continue
+            if cpus:
+                return len(cpus)
+
+    return None
+
+def cpu_limits(cgroup_root='/sys/fs/cgroup', proc_root='/proc'):
+    if hasattr(os, 'sched_getaffinity'):
+        affinity = len(os.sched_getaffinity(0))
+    else:
+        affinity = os.cpu_count()
+
+    cgroups = read_cgroups(proc_root)
+    # On hybrid v1/v2 systems, controllers are in the v1 hierarchies
+    unified = ('' in cgroups) and os.path.exists(os.path.join(cgroup_root, 'cgroup.controllers'))
+
+    return {"affinity": affinity,
+            "cpuset": cpuset_size(cgroup_root, cgroups, unified),
+            "quota": cpu_quota(cgroup_root, cgroups, unified)}
+
+# Returns the number of CPUs the process can keep busy.
+# A fractional quota is rounded up: a quota of 1.5 CPUs can keep two threads busy most of the time.
+def effective_cpu_count(cgroup_root='/sys/fs/cgroup', proc_root='/proc'):
+    limits = cpu_limits(cgroup_root, proc_root)
+
+    count = limits["affinity"]
+    if limits["cpuset"] is not None:
+        count = min(count, limits["cpuset"])
+    if limits["quota"] is not None:
+        count = min(count, math.ceil(limits["quota"]))
+
+    return max(count, 1)
+
+class CPUSampler(object):
+    """ Computes CPU utilization from the differences between /proc/stat snapshots.
+
+        Counters are kept in lists preallocated for all CPUs of the topology,
+        and every sample reads /proc/stat once from an already open file.
+    """
+    def __init__(self, topology, proc_root='/proc'):
+        self.cpus = sorted(topology.cpus)
+        self.labels = [str(c) for c in self.cpus]
+        # /proc/stat line name -> position in the lists
+        self.index = {"cpu{0}".format(c).encode(): i for i, c in enumerate(self.cpus)}
+
+        siblings = topology.siblings()
+        self.cores = [[self.cpus.index(c) for c in siblings[core]] for core in sorted(siblings)]
+        self.core_labels = [",".join(str(c) for c in siblings[core]) for core in sorted(siblings)]
+
+        self.busy = [0] * len(self.cpus)
+        self.total = [0] * len(self.cpus)
+        self.busy_delta = [0] * len(self.cpus)
+        self.total_delta = [0] * len(self.cpus)
+        self.all_busy = 0
+        self.all_total = 0
+
+        self._stat = open(os.path.join(proc_root, 'stat'), 'rb')
+        self.sample()
+
+    def close(self):
+        self._stat.close()
+
+    # Updates the counters and returns busy and total time of all CPUs since the last sample
+    def _read(self):
+        self._stat.seek(0)
+        data = self._stat.read()
+
+        busy_delta = self.busy_delta
+        total_delta = self.total_delta
+        for i in range(len(busy_delta)):
+            busy_delta[i] = 0
+            total_delta[i] = 0
+
+        all_busy = all_total = 0
+        for line in data.split(b'\n'):
+            # CPU lines are always at the beginning
+            if not line.startswith(b'cpu'):
+                break
+
+            # user nice system idle iowait irq softirq steal guest guest_nice.
+            # Guest time is already included in user and nice.
+            fields = line.split()
+            total = sum(map(int, fields[1:9]))
+            busy = total - int(fields[4]) - int(fields[5])
+
+            if fields[0] == b'cpu':
+                all_busy = busy - self.all_busy
+                all_total = total - self.all_total
+                self.all_busy = busy
+                self.all_total = total
+                continue
+
+            i = self.index.get(fields[0])
+            if i is None:
+                # Came online after the topology was read
+                continue
+            busy_delta[i] = busy - self.busy[i]
+            total_delta[i] = total - self.total[i]
+            self.busy[i] = busy
+            self.total[i] = total
+
+        return (all_busy, all_total)
+
+    # Returns utilization in percent since the last sample
+    def sample(self):
+        all_busy, all_total = self._read()
+
+        def percent(busy, total):
+            return round(100 * busy / total, 1) if total > 0 else 0.0
+
+        busy = self.busy_delta
+        total = self.total_delta
+        return {
+            "all": percent(all_busy, all_total),
+            "cpus": dict(zip(self.labels, (percent(busy[i], total[i]) for i in range(len(busy))))),
+            "cores": dict(zip(self.core_labels,
+                              (percent(sum(busy[i] for i in core), sum(total[i] for i in core)) for core in self.cores)))
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--topology', action='store_true', help='Print sockets, physical cores, threads, and NUMA nodes as JSON')
+    parser.add_argument('-e', '--effective', action='store_true', help='Print the number of CPUs available to the process')
+    parser.add_argument('--sample', type=float, metavar='INTERVAL', help='Print CPU and core utilization every INTERVAL seconds as JSON lines')
+    parser.add_argument('-c', '--count', type=int, help='Number of samples to print (default: until interrupted)')
+    parser.add_argument('--sysfs-root', type=str, default='/sys', help='sysfs mount point')
+    parser.add_argument('--proc-root', type=str, default='/proc', help='procfs mount point')
+    parser.add_argument('--cgroup-root', type=str, default='/sys/fs/cgroup', help='cgroup filesystem mount point')
+    args = parser.parse_args()
+
+    if args.sample:
+        sampler = CPUSampler(CPUTopology.detect(args.sysfs_root, args.proc_root), args.proc_root)
+        samples = 0
+        next_time = time.monotonic()
+        try:
+            while (args.count is None) or (samples < args.count):
+                # Sample on a fixed schedule, so that the time it takes doesn't add up
+                next_time += args.sample
+                time.sleep(max(0, next_time - time.monotonic()))
 
-    print(core_count)
+                utilization = sampler.sample()
+                utilization["time"] = round(time.time(), 3)
+                print(json.dumps(utilization, separators=(',', ':')), flush=True)
+                samples += 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sampler.close()
+    elif args.topology:
+        summary = CPUTopology.detect(args.sysfs_root, args.proc_root).summary()
+        if args.effective:
+            summary["effective"] = effective_cpu_count(args.cgroup_root, args.proc_root)
+        print(json.dumps(summary))
+    elif args.effective:
+        print(effective_cpu_count(args.cgroup_root, args.proc_root))
+    else:
+        print(CPUTopology.detect(args.sysfs_root, args.proc_root).cores())
@@ -1,34 +1,304 @@
 #!/usr/bin/env python3
+#
+# Obsessive-compulsive acronym capitalization checker.
+#
+# Checks abbreviation/acronym capitalization style against
+# a file that lists correctly capitalized versions one per line.
+#
+# Usage: ocacc.py [options] <style file> <target file or dir>...
+#
+# Directories are searched recursively for documentation files (see --extensions).
+# Files are checked in parallel (see --jobs), the style file is read and compiled only once.
+#
+# Errors are printed as text by default, or in the "file:line:column: message" format
+# understood by editors and CI tools (--format=line), or as JSON, one object per line (--format=json).
+#
+# With --cache FILE, content hashes of files that had no errors are saved,
+# and files that haven't changed since are skipped on the next run.
+# The cache is discarded when the style file changes.
+#
+# With --fix, incorrectly capitalized terms are replaced with their correct versions.
+# Files are rewritten line by line into a temporary file next to them,
+# which then replaces the original, so files are never held in memory as a whole,
+# and an interrupted run leaves either the old or the new version.
+#
+# Terms are found wherever they are separate words, including next to punctuation,
+# e.g. "(ipv6)" or "vyos,". Terms can consist of multiple words, like "Open Source".
+# If terms overlap, the longest one wins.
+#
+# All terms are compiled into one regex built from a trie of the terms,
+# so the time it takes depends on the size of the target file
+# and on the length of the terms, but not on their number.
 
+import os
 import re
 import sys
+import json
+import stat
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
 
-if len(sys.argv) < 3:
-    print("Usage: {0} <style file> <target file>")
-    sys.exit(1)
-
-line_no = 1
-# Assume success until proven otherwise
-exit_code = 0
-
-# Get the style data
-with open(sys.argv[1], 'r') as f:
-    abbr_list = f.readlines()
-abbr_list = map(lambda s: s.strip(), abbr_list)
-
-abbrs = {}
-for a in abbr_list:
-    abbrs[a.lower()] = a
-
-with open(sys.argv[2], 'r') as f:
-    for line in f:
-        words = re.split(r'\s+', line)
-        for w in words:
-            wl = w.lower()
-            if (wl in abbrs) and (w != abbrs[wl]):
-                print("Line {0}: Incorrect capitalization of {1} ({2})!".format(line_no, abbrs[wl], w))
-                print(line)
+
+# Returns a dict of lowercase terms to their correct versions
+def load_style(path):
+    abbrs = {}
+
+    with open(path, 'r') as f:
+        for line in f:
+            a = " ".join(line.split())
+            if a:
+                abbrs[a.lower()] = a
+
+    return abbrs
+
+def char_pattern(c):
+    if c == " ":
+        # Words of multi-word terms can be separated by any whitespace
+        return r"\s+"
+    else:
+        return re.escape(c)
+
+# Builds a regex that matches any of the terms, from a trie of them.
+# At every position, regex alternatives are tried in order until one matches,
+# so an alternation of all terms would try every term, while in a trie
+# only the terms that share a prefix with the text are tried.
+def trie_pattern(terms):
+    trie = {}
+    for t in terms:
+        node = trie
+        for c in t:
+            node = node.setdefault(c, {})
+        # The end of a term
+        node[""] = {}
+
+    def node_pattern(node):
+        alternatives = [char_pattern(c) + node_pattern(node[c]) for c in sorted(node) if c]
+        if not alternatives:
+            return ""
+        elif (len(alternatives) == 1) and ("" not in node):
+            return alternatives[0]
+        elif "" in node:
+            # The term may end here, but a longer one is preferred
+            return "(?:{0})?".format("|".join(alternatives))
+        else:
+            return "(?:{0})".format("|".join(alternatives))
+
+    return node_pattern(trie)
+
+def compile_matcher(abbrs):
+    # Terms must not be parts of longer words
+    return re.compile(r"(?<!\w)(?:{0})(?!\w)".format(trie_pattern(abbrs)), re.IGNORECASE)
+
+# Returns the correct version of a found term, or None if it's already correct
+def correct_version(abbrs, found):
+    found = " ".join(found.split())
+    correct = abbrs[found.lower()]
+    return correct if found != correct else None
+
+# Yields (line number, column, correct version, found version, line) tuples
+# for every incorrectly capitalized term.
+# Line and column numbers start from 1.
+def find_errors(lines, abbrs, matcher):
+    for line_no, line in enumerate(lines, start=1):
+        for m in matcher.finditer(line):
+            correct = correct_version(abbrs, m.group(0))
+            if correct:
+                yield (line_no, m.start() + 1, correct, m.group(0), line)
+
+# Yields lines with incorrectly capitalized terms replaced by their correct versions,
+# and appends the errors to the list, in the same format as find_errors()
+def fix_lines(lines, abbrs, matcher, errors):
+    for line_no, line in enumerate(lines, start=1):
+        def replace(m):
+            correct = correct_version(abbrs, m.group(0))
+            if correct:
+                errors.append((line_no, m.start() + 1, correct, m.group(0), line.rstrip("\r\n")))
+                return correct
+            else:
+                return m.group(0)
+
+        yield matcher.sub(replace, line)
+
+# Yields the files to check: files given explicitly are always checked,
+# directories are searched for files with given extensions, skipping hidden ones.
+# Files reachable by several paths (e.g. via symlinks) are only yielded once,
+# otherwise they could be fixed by two workers at the same time.
+def find_files(paths, extensions):
+    seen = set()
+
+    def unseen(path):
+        real_path = os.path.realpath(path)
+        if real_path in seen:
+            return False
+        seen.add(real_path)
+        return True
+
+    for path in paths:
+        if not os.path.isdir(path):
+            if unseen(path):
+                yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for f in sorted(files):
+                if (not f.startswith(".")) and f.endswith(extensions) and unseen(os.path.join(root, f)):
+                    yield os.path.join(root, f)
+
+# Style data of pool workers, set once per worker process
+_abbrs = None
+_matcher = None
+
+def init_worker(abbrs):
+    global _abbrs, _matcher
+    _abbrs = abbrs
+    _matcher = compile_matcher(abbrs)
+
+# Returns (file, content hash, errors, exception).
+# If the content hash is the same as the cached one, errors are None.
+def check_file(args):
+    path, cached_hash = args
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        return (path, None, None, e)
+
+    content_hash = hashlib.sha1(data).hexdigest()
+    if content_hash == cached_hash:
+        return (path, content_hash, None, None)
+
+    lines = data.decode(errors='replace').splitlines()
+    return (path, content_hash, list(find_errors(lines, _abbrs, _matcher)), None)
+
+# Same as check_file, but also fixes the errors.
+# The content hash is that of the fixed file.
+def fix_file(args):
+    path, _ = args
+    # Replace the file a symlink points to rather than the symlink
+    real_path = os.path.realpath(path)
+    tmp_path = None
+    errors = []
+    content_hash = hashlib.sha1()
+
+    try:
+        with open(real_path, 'rb') as f:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(real_path),
+                                            prefix=".{0}.".format(os.path.basename(real_path)), suffix=".tmp")
+            with os.fdopen(fd, 'wb') as out:
+                # Undecodable bytes are kept as they are
+                lines = (l.decode(errors='surrogateescape') for l in f)
+                for l in fix_lines(lines, _abbrs, _matcher, errors):
+                    data = l.encode(errors='surrogateescape')
+                    content_hash.update(data)
+                    out.write(data)
+
+        if errors:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(real_path).st_mode))
+            os.replace(tmp_path, real_path)
+        else:
+            os.remove(tmp_path)
+    except OSError as e:
+        if (tmp_path is not None) and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return (path, None, None, e)
+
+    return (path, content_hash.hexdigest(), errors, None)
+
+def format_error(fmt, path, error, show_path):
+    line_no, column, correct, found, line = error
+    if fmt == "json":
+        return json.dumps({"file": path, "line": line_no, "column": column, "expected": correct, "found": found})
+    elif fmt == "line":
+        return "{0}:{1}:{2}: Incorrect capitalization of {3} ({4})".format(path, line_no, column, correct, found)
+    else:
+        message = "Line {0}, column {1}: Incorrect capitalization of {2} ({3})!\n{4}".format(line_no, column, correct, found, line)
+        if show_path:
+            message = "{0}: {1}".format(path, message)
+        return message
+
+def load_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        print("Cache file {0} is malformed, ignoring it".format(path), file=sys.stderr)
+        return {}
+
+def save_cache(path, cache):
+    tmp_path = "{0}.tmp".format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--format', choices=['text', 'line', 'json'], default='text', help='Output format')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of parallel jobs')
+    parser.add_argument('-e', '--extensions', type=str, default='.md,.rst,.txt,.adoc,.html',
+                        help='Comma-separated extensions of files to check in directories')
+    parser.add_argument('--cache', type=str, help='Cache file for content hashes of files without errors')
+    parser.add_argument('--fix', action='store_true', help='Replace incorrectly capitalized terms with their correct versions')
+    parser.add_argument('style_file', type=str, help='File with correctly capitalized terms, one per line')
+    parser.add_argument('targets', type=str, nargs='+', help='Files or directories to check')
+    args = parser.parse_args()
+
+    # Assume success until proven otherwise
+    exit_code = 0
+
+    # Get the style data
+    abbrs = load_style(args.style_file)
+
+    # Cached hashes are only valid for the same style data
+    style_hash = hashlib.sha1(json.dumps(abbrs, sort_keys=True).encode()).hexdigest()
+    cache = {}
+    if args.cache:
+        cache = load_cache(args.cache)
+        if cache.get("style") != style_hash:
+            cache = {"style": style_hash}
+    file_cache = cache.setdefault("files", {})
+
+    extensions = tuple(e.strip() for e in args.extensions.split(",") if e.strip())
+    files = ((f, file_cache.get(os.path.abspath(f))) for f in find_files(args.targets, extensions))
+    show_path = (len(args.targets) > 1) or os.path.isdir(args.targets[0])
+
+    worker = fix_file if args.fix else check_file
+
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(abbrs,))
+        results = pool.imap(worker, files, chunksize=16)
+    else:
+        pool = None
+        init_worker(abbrs)
+        results = map(worker, files)
+
+    try:
+        for path, content_hash, errors, exception in results:
+            key = os.path.abspath(path)
+            if exception is not None:
+                print("Could not process {0}: {1}".format(path, exception), file=sys.stderr)
                 exit_code = 1
-        line_no += 1
+            elif errors and not args.fix:
+                for e in errors:
+                    print(format_error(args.format, path, e, show_path))
+                file_cache.pop(key, None)
+                exit_code = 1
+            else:
+                # Fixed errors are still reported, but the file is clean now
+                for e in errors or []:
+                    print(format_error(args.format, path, e, show_path))
+                file_cache[key] = content_hash
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if args.cache:
+        save_cache(args.cache, cache)
 
-sys.exit(exit_code)
+    sys.exit(exit_code)